@@ -1,50 +1,313 @@
-import rowordnet as rwn
-from transformers import AutoTokenizer, AutoModel
-import torch
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
 from text_preprocessing import TextPreprocessor  # Import TextPreprocessor
 
 
+# RoWordNet and the BERT models are loaded once per process and shared by every AmbiguityDetector;
+# the lock keeps concurrent first calls from loading the same thing twice
+_load_lock = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def _load_wordnet():
+    import rowordnet as rwn
+    return rwn.RoWordNet()
+
+
+@lru_cache(maxsize=16384)
+def _load_synsets(wn, literal):
+    # shared like RoWordNet itself, so every detector reuses the literals already looked up; bounded, since
+    # a long-running process sees many distinct tokens, most of them without synsets
+    return tuple(wn.synset(synset_id) for synset_id in wn.synsets(literal=literal))
+
+
+def _default_device():
+    import torch
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def _enable_tf32(device):
+    import torch
+    if torch.device(device).type == "cuda":
+        # process-wide and changes float32 results, so only when asked for
+        torch.backends.cuda.matmul.allow_tf32 = True
+
+
+@lru_cache(maxsize=None)
+def _load_bert(bert_model, precision, device, compile_model):
+    """
+    :return: tuple (tokenizer, model) with the model on the device and in eval mode
+    """
+
+    import torch
+    from transformers import AutoTokenizer, AutoModel
+
+    tokenizer = AutoTokenizer.from_pretrained(bert_model, use_fast=True)
+    model = AutoModel.from_pretrained(bert_model).to(device, getattr(torch, precision)).eval()
+    if compile_model:
+        # batch size and sequence length change on every call
+        model = torch.compile(model, dynamic=True)
+    return tokenizer, model
+
+
 class AmbiguityDetector:
-    def __init__(self, base_url="http://127.0.0.1:5000", bert_model="dumitrescustefan/bert-base-romanian-uncased-v1"):
+    def __init__(self, base_url="http://127.0.0.1:5000", bert_model="dumitrescustefan/bert-base-romanian-uncased-v1",
+                 precision="float32", compile_model=False, embedding_cache_size=4096, device=None, batch_size=64,
+                 allow_tf32=False):
+        """
+        :param base_url: the base url of the Teprolin server
+        :param bert_model: name of the BERT model used for the embeddings
+        :param precision: torch dtype the model runs in ("float32", "bfloat16" or "float16")
+        :param compile_model: compile the model with torch.compile when it is loaded
+        :param embedding_cache_size: how many text embeddings are kept in memory
+        :param device: torch device for the model, defaults to "cuda" when available and "cpu" otherwise
+        :param batch_size: how many texts go through the model at once when embedding
+        :param allow_tf32: let float32 matrix multiplications use TF32 on CUDA; faster, but slightly less precise
+                           and set for the whole process, so it applies to every detector once one enables it
+        """
+
         self.text_preprocessor = TextPreprocessor(base_url)
-        self.wn = rwn.RoWordNet()
-        self.tokenizer = AutoTokenizer.from_pretrained(bert_model)
-        self.model = AutoModel.from_pretrained(bert_model)
+        self.bert_model = bert_model
+        self.precision = precision
+        self.compile_model = compile_model
+        self.embedding_cache_size = embedding_cache_size
+        self.device = device
+        self.batch_size = batch_size
+        self.allow_tf32 = allow_tf32
+        self._embedding_cache = OrderedDict()  # text digest -> embedding, least recently used first
+        self._embedding_cache_lock = threading.Lock()
+
+        # definition embeddings precomputed on disk, see load_definition_embeddings
+        self._stored_embeddings = None
+        self._stored_rows = {}  # text digest -> row in self._stored_embeddings
+
+        # RoWordNet and BERT are slow to import and load, so they are only loaded on first use
+        self._wn = None
+        self._tokenizer = None
+        self._model = None
+
+    @property
+    def wn(self):
+        if self._wn is None:
+            with _load_lock:
+                self._wn = _load_wordnet()
+        return self._wn
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            self._load_bert()
+        return self._tokenizer
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._load_bert()
+        return self._model
+
+    def _load_bert(self):
+        with _load_lock:
+            if self.device is None:
+                self.device = _default_device()
+            if self.allow_tf32:
+                _enable_tf32(self.device)
+            self._tokenizer, self._model = _load_bert(self.bert_model, self.precision, self.device, self.compile_model)
 
     def get_bert_embedding(self, word):
 
-        inputs = self.tokenizer(word, return_tensors="pt", padding=True, truncation=True)
-        with torch.no_grad():
-            outputs = self.model(**inputs)
-        embedding = outputs.last_hidden_state.mean(dim=1).squeeze()
-        return embedding.numpy()
+        return self.get_bert_embeddings([word])[0]
+
+    def get_bert_embeddings(self, texts):
+        """
+        Embeds the texts, running the model only for the ones not already cached
+        :param texts: list of strings
+        :return: array of shape (len(texts), hidden_size)
+        """
+
+        if not texts:
+            return np.empty((0, self._hidden_size()), dtype=np.float32)
+
+        cache = self._embedding_cache
+        keys = [self._cache_key(text) for text in texts]
+        with self._embedding_cache_lock:
+            embeddings = [cache.get(key) for key in keys]
+
+        if self._stored_rows:
+            for i, key in enumerate(keys):
+                row = self._stored_rows.get(key)
+                if embeddings[i] is None and row is not None:
+                    embeddings[i] = self._stored_embeddings[row].astype(np.float32)
+
+        # each distinct text goes through the model once, however often it repeats in the batch
+        missing = {}  # key -> text
+        for key, text, embedding in zip(keys, texts, embeddings):
+            if embedding is None:
+                missing.setdefault(key, text)
+        if missing:
+            # at most batch_size texts per forward pass, sorted by length so short words aren't padded to the
+            # longest definition; copies, so a cached row doesn't keep the whole batch array alive
+            missing_keys = sorted(missing, key=lambda key: len(missing[key]))
+            encoded = {}
+            for start in range(0, len(missing_keys), self.batch_size):
+                batch = missing_keys[start:start + self.batch_size]
+                encoded.update((key, row.copy()) for key, row in zip(batch, self._encode([missing[k] for k in batch])))
+            embeddings = [encoded[key] if embedding is None else embedding for key, embedding in zip(keys, embeddings)]
+
+        with self._embedding_cache_lock:
+            for key, embedding in zip(keys, embeddings):
+                cache[key] = embedding
+                cache.move_to_end(key)
+            while len(cache) > self.embedding_cache_size:
+                cache.popitem(last=False)
+
+        return np.stack(embeddings)  # a copy, so callers can't modify the cached rows
+
+    def save_definition_embeddings(self, directory, batch_size=256):
+        """
+        Embeds the definitions of all the synsets in RoWordNet and saves them, so they don't have to be
+        recomputed by every process
+        :param directory: where embeddings.npy, keys.npy and metadata.json are written
+        :param batch_size: how many definitions go through the model at once
+        """
+
+        definitions = list(dict.fromkeys(self.wn.synset(synset_id).definition for synset_id in self.wn.synsets()))
+
+        embeddings = np.concatenate([
+            self._encode(definitions[start:start + batch_size]).astype(np.float16)
+            for start in range(0, len(definitions), batch_size)
+        ])
+        # raw bytes rather than an "S16" array, which would strip trailing null bytes from the digests
+        keys = np.frombuffer(b"".join(self._cache_key(definition) for definition in definitions), dtype=np.uint8)
+
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, "embeddings.npy"), embeddings)
+        np.save(os.path.join(directory, "keys.npy"), keys.reshape(len(definitions), -1))
+
+        # the rows are only comparable with embeddings from the same model
+        metadata = {"bert_model": self.bert_model, "precision": self.precision, "hidden_size": embeddings.shape[1],
+                    "rows": embeddings.shape[0]}
+        with open(os.path.join(directory, "metadata.json"), "w", encoding="utf-8") as file:
+            json.dump(metadata, file)
+
+    def load_definition_embeddings(self, directory):
+        """
+        Uses the definition embeddings written by save_definition_embeddings instead of running the model for them;
+        the embeddings are memory-mapped, not read into memory
+        :param directory: the directory passed to save_definition_embeddings
+        :raises ValueError: if the embeddings were computed with a different model or the files don't match
+        """
+
+        with open(os.path.join(directory, "metadata.json"), encoding="utf-8") as file:
+            metadata = json.load(file)
+        if metadata["bert_model"] != self.bert_model:
+            raise ValueError(f"Embeddings in {directory} were computed with {metadata['bert_model']}, "
+                             f"not {self.bert_model}")
+
+        embeddings = np.load(os.path.join(directory, "embeddings.npy"), mmap_mode="r")
+        if embeddings.ndim != 2 or embeddings.shape[1] != metadata["hidden_size"]:
+            raise ValueError(f"Embeddings in {directory} have shape {embeddings.shape}, "
+                             f"expected rows of size {metadata['hidden_size']}")
+
+        # keys.npy and embeddings.npy from different or partial saves would map digests to the wrong rows
+        keys = np.load(os.path.join(directory, "keys.npy"))
+        rows = metadata.get("rows", embeddings.shape[0])
+        if not len(keys) == embeddings.shape[0] == rows:
+            raise ValueError(f"{directory} has {len(keys)} keys and {embeddings.shape[0]} embeddings, "
+                             f"expected {rows} of each")
+
+        self._stored_embeddings = embeddings
+        self._stored_rows = {key.tobytes(): row for row, key in enumerate(keys)}
+
+    def _hidden_size(self):
+        # without loading the model's weights just for the size
+        if self._stored_embeddings is not None:
+            return self._stored_embeddings.shape[1]
+        if self._model is not None:
+            return self._model.config.hidden_size
+
+        from transformers import AutoConfig
+        return AutoConfig.from_pretrained(self.bert_model).hidden_size
+
+    @staticmethod
+    def _cache_key(text):
+        # the tokenizer splits on any run of whitespace, so texts differing only in spacing embed the same
+        # and can share an entry; a fixed-size digest keeps long definitions out of memory as cache keys
+        normalized = " ".join(text.split())
+        return hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).digest()
+
+    def _encode(self, texts):
+        """
+        Embeds all the texts with a single padded forward pass
+        :param texts: list of strings
+        :return: array of shape (len(texts), hidden_size)
+        """
+        import torch
+
+        model = self.model  # loads the model and resolves self.device on first use
+        inputs = self.tokenizer(texts, return_tensors="pt", padding=True, truncation=True).to(self.device)
+        with torch.inference_mode():
+            outputs = model(**inputs)
+
+        # pool in float32 whatever the model precision; numpy has no bfloat16
+        hidden_states = outputs.last_hidden_state.float()
+
+        # mean over the real tokens only, so padding doesn't change the embeddings
+        mask = inputs["attention_mask"].unsqueeze(-1).to(hidden_states.dtype)
+        embeddings = (hidden_states * mask).sum(dim=1) / mask.sum(dim=1)
+        return embeddings.cpu().numpy()
+
+    def get_synsets(self, word):
+        """
+        :param word: literal to look up in RoWordNet
+        :return: tuple with the word's synsets, cached per literal for the whole process
+        """
+
+        return _load_synsets(self.wn, word)
 
     def find_ambiguous_words(self, text):
         tokens = self.text_preprocessor.tokenize(text)
         ambiguous_words = []
 
+        # words with multiple meanings in RWN, along with their synsets
+        candidates = []
         for word in tokens:
-            synset_ids = self.wn.synsets(literal=word)  # synsets for the word
+            syn_sets = self.get_synsets(word)  # synsets for the word
+            if len(syn_sets) > 1:
+                candidates.append((word, syn_sets))
 
-            if len(synset_ids) > 1:  # word with multiple meanings in RWN
-                syn_sets = [self.wn.synset(synset_id) for synset_id in synset_ids]
+        if not candidates:
+            return ambiguous_words
 
-                # embeddings for all synsets' definitions
-                sense_embeddings = [self.get_bert_embedding(synset.definition) for synset in syn_sets]
+        # embeddings for every candidate word followed by its synsets' definitions, embedded together;
+        # an uncased tokenizer lowercases anyway, so doing it here only makes the cache hit more often
+        lowercase = getattr(self.tokenizer, "do_lower_case", False)
+        texts = []
+        for word, syn_sets in candidates:
+            texts.append(word.lower() if lowercase else word)
+            texts.extend(synset.definition for synset in syn_sets)
+        embeddings = self.get_bert_embeddings(texts)
 
-                # average embedding across all senses
-                avg_sense_embedding = np.mean(sense_embeddings, axis=0)  # Average across all senses
+        start = 0
+        for word, syn_sets in candidates:
+            word_embedding = embeddings[start]
+            sense_embeddings = embeddings[start + 1:start + 1 + len(syn_sets)]
+            start += 1 + len(syn_sets)
 
-                # embedding for the word in context
-                word_embedding = self.get_bert_embedding(word)
+            # average embedding across all senses
+            avg_sense_embedding = np.mean(sense_embeddings, axis=0)  # Average across all senses
 
-                # Compare the word's embedding with its meanings
-                similarity = cosine_similarity([word_embedding], [avg_sense_embedding])[0][0]
+            # Compare the word's embedding with its meanings
+            similarity = np.dot(word_embedding, avg_sense_embedding) / (
+                np.linalg.norm(word_embedding) * np.linalg.norm(avg_sense_embedding))
 
-                if similarity < 0.8:  # If too different from all meanings
-                    ambiguous_words.append(word)
+            if similarity < 0.8:  # If too different from all meanings
+                ambiguous_words.append(word)
 
         return ambiguous_words
 
@@ -1,50 +1,106 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+try:
+    import orjson  # faster decoding of the Teprolin responses, used when installed
+except ImportError:
+    orjson = None
+
+
+# values of the "exec" field for the NLP tasks
+TOKENIZATION = "tokenization"
+POS_TAGGING = "pos-tagging"
+NER = "named-entity-recognition"
+DEPENDENCY_PARSING = "dependency-parsing"
+ALL_TASKS = ",".join((TOKENIZATION, POS_TAGGING, NER, DEPENDENCY_PARSING))
+
+DEPENDENCY_MODEL = "udpipe-ufal"
+
+
+def _parse_json(response):
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
+
+
+class _CircuitBreaker:
+    """
+    Fails fast while Teprolin is down: after max_failures failed requests in a row, requests are refused
+    for reset_after seconds, then a single request is let through to check whether the server is back
+    """
+
+    def __init__(self, max_failures: int, reset_after: float):
+
+        self.max_failures = max_failures
+        self.reset_after = reset_after
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False  # a request checking whether the server is back is in flight
+        self._lock = threading.Lock()
+
+    def check(self):
+        with self._lock:
+            if self._failures < self.max_failures:
+                return
+            if not self._probing and time.monotonic() - self._opened_at >= self.reset_after:
+                self._probing = True  # this caller is the probe, the others keep failing fast
+                return
+            failures = self._failures
+        raise requests.ConnectionError(f"Teprolin unavailable after {failures} failed requests")
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._failures >= self.max_failures:
+                self._opened_at = time.monotonic()
 
 
 class TextPreprocessor:
 
-    def __init__(self, base_url: str='http://127.0.0.1:5000'):
+    def __init__(self, base_url: str='http://127.0.0.1:5000', cache_size: int=1024, timeout: tuple=(3.0, 30.0),
+                 max_failures: int=5, reset_after: float=30.0):
 
         """
         :param base_url: the base url of the Teprolin server
+        :param cache_size: how many Teprolin results are kept in memory
+        :param timeout: (connect, read) timeout in seconds for the Teprolin requests
+        :param max_failures: failed requests in a row after which Teprolin is considered down
+        :param reset_after: seconds to wait before trying Teprolin again once it is considered down
         """
 
         self.base_url = base_url
+        self.process_url = f"{base_url}/process"  # endpoint for NLP tasks
+        self.cache_size = cache_size
+        self.timeout = timeout
+        self._breaker = _CircuitBreaker(max_failures, reset_after)
+        self.session = requests.Session()  # keeps the connection to Teprolin alive between calls
+        # only POSTs whose connection could not be opened are retried; read errors, including a connection
+        # dropped mid-request, mean the server may have the text already, so they are raised as they are
+        retries = Retry(total=2, connect=2, read=False, status=0, backoff_factor=0.1,
+                        allowed_methods=frozenset({"POST"}))
+        # room for threads sharing the preprocessor
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=32, max_retries=retries)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._cache = OrderedDict()  # (task, options, text digest) -> result, least recently used first
+        self._cache_lock = threading.Lock()
 
     def tokenize(self, text: str):
 
-        endpoint = "/process"  # endpoint for NLP tasks
-        data = {
-            "text": text,  #  input text to be tokenized
-            "exec": "tokenization"  # NLP task
-        }
-
-        response = requests.post(f"{self.base_url}{endpoint}", data=data)
-
-        # print(f"Response Status Code: {response.status_code}")
-        # print(f"Response Content: {response.text}")
-
-        if response.status_code == 200:
-            try:
-                data = response.json()
-                print(f"JSON Response: {data}")
-                tokens = []
-
-                # tokens are dictionaries
-                tokenized_data = data.get("teprolin-result", {}).get("tokenized", [])
-                for sentence in tokenized_data:
-                    for token_info in sentence:
-                        word = token_info.get("_wordform", "")
-                        if word:
-                            tokens.append(word)
-
-                return tokens
-            except Exception as e:
-                print(f"Error parsing JSON: {e}")
-                return []
-        else:
-            print(f"Error: {response.status_code} - {response.text}")
-            return []
+        return self._process(text, TOKENIZATION, _extract_tokens) or []
 
     def pos_tagging(self, tokens: list):
         """
@@ -54,31 +110,7 @@ class TextPreprocessor:
 
         text = " ".join(tokens)  # the input for Teprolin is a string
 
-        endpoint = "/process"
-        data = {
-            "text": text,
-            "exec": "pos-tagging"
-        }
-
-        response = requests.post(f"{self.base_url}{endpoint}", data=data)
-
-        # print(f"Response Status Code: {response.status_code}")
-        # print(f"Response Content: {response.text}")
-
-        if response.status_code == 200:
-            try:
-                data = response.json()
-                pos_tags = data.get("teprolin-result", {}).get("tokenized", [])
-                if pos_tags:
-                    # Flattening and extracting word and POS
-                    pos_tags = [(word["_wordform"], word["_ctg"]) for sentence in pos_tags for word in sentence]
-                return pos_tags
-            except Exception as e:
-                print(f"Error parsing JSON: {e}")
-                return []
-        else:
-            print(f"Error: {response.status_code} - {response.text}")
-            return []
+        return self._process(text, POS_TAGGING, _extract_pos_tags) or []
 
     def ner(self, tokens: list):
         """
@@ -88,68 +120,159 @@ class TextPreprocessor:
         """
         text = " ".join(tokens)
 
-        endpoint = "/process"
-        data = {
-            "text": text,
-            "exec": "named-entity-recognition"
-        }
+        return self._process(text, NER, _extract_ner) or []
+
+    def dependency_parsing(self, text: str):
 
-        response = requests.post(f"{self.base_url}{endpoint}", data=data)
+        return self._process(text, DEPENDENCY_PARSING, _extract_dependencies, model=DEPENDENCY_MODEL) or []
+
+    def analyze(self, text: str):
+        """
+        Runs tokenization, POS tagging, NER and dependency parsing with a single Teprolin request,
+        instead of one request for each of them
+        :param text: input text
+        :return: dictionary with "tokens", "pos_tags", "ner" and "dependencies", built as by the methods above
+        """
+
+        return self._process(text, ALL_TASKS, _extract_all, model=DEPENDENCY_MODEL) or {
+            "tokens": [], "pos_tags": [], "ner": [], "dependencies": []}
+
+    def analyze_texts(self, texts: list, max_workers: int=8):
+        """
+        Analyzes several texts, with up to max_workers Teprolin requests in flight at once
+        :param texts: list of input texts
+        :param max_workers: how many requests are sent concurrently, kept within the session's connection pool
+        :return: list with the analyze() result of each text, in the same order
+        """
+
+        # each distinct text is sent once; the copies would all miss the cache while the first is in flight
+        unique_texts = list(dict.fromkeys(texts))
+        if len(unique_texts) <= 1:
+            results = {text: self.analyze(text) for text in unique_texts}
+        else:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(unique_texts))) as executor:
+                results = dict(zip(unique_texts, executor.map(self.analyze, unique_texts)))
+
+        return [results[text] for text in texts]
+
+    def clear_cache(self):
+
+        with self._cache_lock:
+            self._cache.clear()
+
+    def _process(self, text: str, task: str, extract, **options):
+        """
+        Sends the text to Teprolin's /process endpoint
+        :param text: input text
+        :param task: the NLP task(s) to execute, comma separated
+        :param extract: function building the result from the list of tokenized sentences
+        :param options: extra form fields, e.g. the model
+        :return: what extract returns, or None if the request or the parsing failed; repeated calls
+                 with the same text, task and options are answered from the cache
+        """
+
+        if not text or text.isspace():
+            return extract([])  # nothing for Teprolin to process
+
+        key = (task, tuple(sorted(options.items())), hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest())
+        with self._cache_lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+        if cached is not None:
+            return _thaw(cached)
+
+        result = self._request(text, task, extract, **options)
+
+        # only successful results are cached, stored as tuples so callers can't change them
+        if result is not None:
+            with self._cache_lock:
+                self._cache[key] = _freeze(result)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+        return result
+
+    def _request(self, text: str, task: str, extract, **options):
+
+        # a hung or unreachable server raises after the timeout, and right away once the breaker is open
+        self._breaker.check()
+        try:
+            response = self.session.post(self.process_url, data={"text": text, "exec": task, **options},
+                                         timeout=self.timeout)
+        except BaseException:  # even Ctrl-C, so an interrupted probe never leaves the breaker waiting for it
+            self._breaker.record_failure()
+            raise
+        self._breaker.record_success()
 
         # print(f"Response Status Code: {response.status_code}")
         # print(f"Response Content: {response.text}")
 
         if response.status_code == 200:
             try:
-                data = response.json()
-                ner_result = data.get("teprolin-result", {}).get("tokenized", [])
-                if ner_result:
-                    ner_result = [(word["_wordform"], word["_ner"]) for sentence in ner_result for word in sentence]
-                return ner_result
+                data = _parse_json(response)
+                return extract(data.get("teprolin-result", {}).get("tokenized", []))
             except Exception as e:
                 print(f"Error parsing JSON: {e}")
-                return []
+                return None
         else:
             print(f"Error: {response.status_code} - {response.text}")
-            return []
+            return None
 
-    def dependency_parsing(self, text: str):
-        endpoint = "/process"
-        data = {
-            "text": text,  # input text
-            "exec": "dependency-parsing",  # NLP task
-            "model": "udpipe-ufal"
-        }
 
-        response = requests.post(f"{self.base_url}{endpoint}", data=data)
+def _freeze(result):
+    if isinstance(result, dict):
+        return {key: tuple(values) for key, values in result.items()}
+    return tuple(result)
 
-        if response.status_code == 200:
-            try:
-                data = response.json()
-                # print(f"JSON Response: {data}")
 
-                dependencies = []
+def _thaw(result):
+    if isinstance(result, dict):
+        return {key: list(values) for key, values in result.items()}
+    return list(result)
 
-                # extract dependency information from tokenized data
-                tokenized_data = data.get("teprolin-result", {}).get("tokenized", [])
-                for sentence in tokenized_data:
-                    for token_info in sentence:
-                        word = token_info.get("_wordform", "")
-                        dependency_relation = token_info.get("_deprel", "")
-                        head = token_info.get("_head", "")
 
-                        if word:
-                            dependencies.append((word, dependency_relation, head))
+# the tokenized data is a list of sentences, each a list of token dictionaries
 
-                return dependencies
+def _extract_tokens(tokenized_data):
+    words = (token_info.get("_wordform") for sentence in tokenized_data for token_info in sentence)
+    return [word for word in words if word]
 
-            except Exception as e:
-                print(f"Error parsing JSON: {e}")
-                return []
-        else:
-            print(f"Error: {response.status_code} - {response.text}")
-            return []
 
+def _extract_pos_tags(tokenized_data):
+    return [(word["_wordform"], word["_ctg"]) for sentence in tokenized_data for word in sentence]
+
+
+def _extract_ner(tokenized_data):
+    return [(word["_wordform"], word["_ner"]) for sentence in tokenized_data for word in sentence]
+
+
+def _extract_dependencies(tokenized_data):
+    dependencies = []
+    append = dependencies.append  # bound once, these loops run for every token
+    for sentence in tokenized_data:
+        for token_info in sentence:
+            word = token_info.get("_wordform")
+            if word:
+                append((word, token_info.get("_deprel", ""), token_info.get("_head", "")))
+    return dependencies
+
+
+def _extract_all(tokenized_data):
+    tokens, pos_tags, ner, dependencies = [], [], [], []
+
+    # every token carries the fields of all the tasks, so they are extracted in one pass
+    for sentence in tokenized_data:
+        for token_info in sentence:
+            get = token_info.get
+            word = get("_wordform", "")
+            pos_tags.append((word, get("_ctg", "")))
+            ner.append((word, get("_ner", "")))
+            if word:
+                tokens.append(word)
+                dependencies.append((word, get("_deprel", ""), get("_head", "")))
+
+    return {"tokens": tokens, "pos_tags": pos_tags, "ner": ner, "dependencies": dependencies}
 
 
 if __name__ == '__main__':